@@ -1,15 +1,20 @@
 """Common configuration items used by the application."""
-import json
 import pathlib
 import random
+from functools import cache
+
+import orjson
 
 BASE_DIRECTORY = pathlib.Path(__file__).parent.resolve()
 
 
+@cache
+def get_user_agents():
+    """Read the list of commonly used agents from a file."""
+    user_agents = orjson.loads((BASE_DIRECTORY / "data" / "common_user_agents.json").read_bytes())
+    return tuple(x["ua"] for x in user_agents)
+
+
 def random_user_agent():
     """Choose a user agent from a list of commonly used agents."""
-    with open(f"{BASE_DIRECTORY}/data/common_user_agents.json", "r") as fileh:
-        user_agents = json.load(fileh)
-
-    random.shuffle(user_agents)
-    return [x["ua"] for x in user_agents][0]
+    return random.choice(get_user_agents())
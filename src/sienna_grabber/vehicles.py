@@ -1,15 +1,19 @@
 """Get a list of Toyota vehicles from the Toyota website."""
+import io
 import os
 import sys
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import cache
+from pathlib import Path
 from secrets import randbelow
-from time import sleep
-from timeit import default_timer as timer
+from time import sleep, time
 
+import orjson
 import pandas as pd
 import requests
-import warnings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from sienna_grabber import config, wafbypass
 
@@ -20,116 +24,269 @@ MODEL = os.environ.get("MODEL")
 ZIPCODE = os.environ.get("ZIPCODE")
 DISTANCE = os.environ.get("DISTANCE")
 
+# Set INCREMENTAL=1 to build on the previous run's vehicles instead of crawling
+# every page again.
+INCREMENTAL = os.environ.get("INCREMENTAL") == "1"
+
+# In incremental runs, a page where at most this share of VINs is unknown ends
+# the crawl. Once vehicles carried over from earlier runs are older than this,
+# every page is crawled again instead.
+INCREMENTAL_NEW_VIN_SHARE = 0.1
+INCREMENTAL_MAX_AGE = 36 * 60 * 60
+
+# Toyota's API won't return any vehicles past page 40.
+MAX_PAGES = 40
+
+# Number of pages requested in parallel per round.
+PAGE_BATCH_SIZE = 4
+
+# Share one keep-alive session (and its connection pool) across the page fetching
+# threads and WAF bypass refreshes. The GraphQL query is read-only, so retrying
+# the POST on gateway errors is safe. Throttling is handled in get_all_pages.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=2 * PAGE_BATCH_SIZE,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502],
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# Only back off when the server says it is overloaded or rate limiting us, or
+# when a page fails. Pages that still fail after the last attempt end the run.
+THROTTLE_STATUSES = (429, 503)
+THROTTLE_DELAY = 5
+THROTTLE_MAX_DELAY = 60
+THROTTLE_ATTEMPTS = 3
+
+# CSV column names for each source column, in the order they are written.
+_RENAMES = {
+    "eta.currToDate": "ETA",
+    "vin": "VIN",
+    "year": "Year",
+    "model.marketingName": "Model",
+    "holdStatus": "Hold Status",
+    "isPreSold": "Pre-Sold",
+    "dealerCategory": "Shipping Status",
+    "price.totalMsrp": "Total MSRP",
+    "extColor.marketingName": "Exterior Color",
+    "intColor.marketingName": "Interior Color",
+    "distance": "Distance",
+    "dealerMarketingName": "Dealer",
+    "dealerWebsite": "Dealer Website",
+    "isSmartPath": "SmartPath",
+    "options": "Options",
+}
+_SRC_COLS = list(_RENAMES)
+
+# Columns used in the CSV, mapped to their path in a nested vehicle record.
+FLATTEN = [(src, tuple(src.split("."))) for src in _SRC_COLS]
+
 @cache
 def get_vehicles_query():
-    """Read vehicles query from a file."""
+    """Read vehicles query template from a file."""
     with open(f"{config.BASE_DIRECTORY}/graphql/vehicles.graphql", "r") as fileh:
-        query = fileh.read()
+        return fileh.read()
+
+
+def read_raw_vehicles():
+    """Read the raw vehicle records saved by a previous run."""
+    path = Path(f"output/{MODEL}_raw.json")
+    if not path.exists():
+        return []
+
+    return orjson.loads(path.read_bytes())
 
-    # Replace certain place holders in the query with values.
-    query = query.replace("ZIPCODE", ZIPCODE)
-    query = query.replace("MODELCODE", MODEL)
-    query = query.replace("DISTANCEMILES", DISTANCE)
-    query = query.replace("LEADIDUUID", str(uuid.uuid4()))
 
-    return query
+def read_previous_vehicles():
+    """Read the previous run's vehicles, unless they are due a full crawl."""
+    previous = read_raw_vehicles()
+    if previous and time() - min(v.get("lastSeen", 0) for v in previous) > INCREMENTAL_MAX_AGE:
+        print("Previous vehicles are too old, getting every page.")
+        return []
+
+    return previous
 
 
 def read_local_data():
     """Read local raw data from the disk instead of querying Toyota."""
-    return pd.read_json(f"output/{MODEL}_raw.json")
+    return pd.json_normalize(read_raw_vehicles())
 
 def upload_output():
     sync_data_to_api(read_local_data())
 
 
-def query_toyota(page_number, query, headers):
+def query_toyota(page_number, headers):
     """Query Toyota for a list of vehicles."""
 
-    # Replace the page number in the query
-    query = query.replace("PAGENUMBER", str(page_number))
+    # Fill in the query template, using a fresh lead id for each request.
+    query = get_vehicles_query() % {
+        "zipcode": ZIPCODE,
+        "model": MODEL,
+        "distance": DISTANCE,
+        "lead_id": uuid.uuid4(),
+        "page_number": page_number,
+    }
 
     # Make request.
     json_post = {"query": query}
     url = "https://api.search-inventory.toyota.com/graphql"
-    resp = requests.post(
-        url,
-        json=json_post,
-        headers=headers,
-        timeout=15,
-    )
+    resp = _SESSION.post(url, json=json_post, headers=headers, timeout=15)
+
+    # The WAF rejected our headers, so get fresh ones and try once more.
+    if resp.status_code in (401, 403):
+        headers = wafbypass.refresh(headers)
+        resp = _SESSION.post(url, json=json_post, headers=headers, timeout=15)
+
+    retry_after = resp.headers.get("Retry-After")
 
     try:
         result = resp.json()["data"]["locateVehiclesByZip"]
     except Exception as e:
         print(resp.headers)
         print(resp.text)
-        return None
+        return None, resp.status_code, retry_after
 
     if not result or "vehicleSummary" not in result:
         print(resp.text)
-        return None
+        return None, resp.status_code, retry_after
     else:
-        return result
+        return result, resp.status_code, retry_after
 
 
-def get_all_pages():
-    """Get all pages of results for a query to Toyota."""
-    df = pd.DataFrame()
-    page_number = 1
+def retry_delay(retry_after):
+    """Work out how long to wait after the server throttled us."""
+    # Waiting too long would let the WAF bypass headers expire.
+    if retry_after and retry_after.isdigit() and int(retry_after) <= THROTTLE_MAX_DELAY:
+        return int(retry_after)
 
-    # Read the query.
-    query = get_vehicles_query()
+    return THROTTLE_DELAY
 
-    # Get headers by bypassing the WAF.
-    print("Bypassing WAF")
-    headers = wafbypass.WAFBypass().run()
 
-    # Start a timer.
-    timer_start = timer()
+def get_all_pages(known_vins=frozenset()):
+    """Get all pages of results for a query to Toyota.
+
+    Also returns the last page fetched if the crawl stopped early because the
+    pages were mostly known vehicles, or None if it reached the end.
+    """
+    vehicles = {}
+    seen_vins = set()
+    page_number = 1
+
+    # Unless we already know about some vehicles, only a page without any new
+    # VINs ends the crawl.
+    new_vin_share = INCREMENTAL_NEW_VIN_SHARE if known_vins else 0
 
     # Set a last run counter.
     last_run_counter = 0
 
-    while True:
-        # Toyota's API won't return any vehicles past past 40.
-        if page_number > 40:
-            break
+    # Toyota tells us how many pages there are with every page of results.
+    total_pages = MAX_PAGES
+    reached_end = False
 
-        # The WAF bypass expires every 5 minutes, so we refresh about every 4 minutes.
-        elapsed_time = timer() - timer_start
-        if elapsed_time > 4 * 60:
-            print("  >>> Refreshing WAF bypass >>>\n")
+    with ThreadPoolExecutor(max_workers=PAGE_BATCH_SIZE) as executor:
+        while page_number <= total_pages:
+            # Get headers by bypassing the WAF. Cached headers are reused until they
+            # are about to expire, so this only launches a browser when needed.
             headers = wafbypass.WAFBypass().run()
-            timer_start = timer()
-
-        # Get a page of vehicles.
-        print(f"Getting page {page_number} of {MODEL} vehicles")
-
-        result = query_toyota(page_number, query, headers)
-        if result and "vehicleSummary" in result:
-            with warnings.catch_warnings():
-                # TODO: pandas 2.1.0 has a FutureWarning for concatenating DataFrames with Null entries
-                warnings.filterwarnings("ignore", category=FutureWarning)
-                df = pd.concat([df, pd.json_normalize(result["vehicleSummary"])])
 
-        # Drop any duplicate VINs.
-        df.drop_duplicates(subset=["vin"], inplace=True)
-
-        print(f"Found {len(df)} (+{len(df)-last_run_counter}) vehicles so far.\n")
-
-        # If we didn't find more cars from the previous run, we've found them all.
-        if len(df) == last_run_counter:
-            print("All vehicles found.")
-            break
-
-        last_run_counter = len(df)
-        page_number += 1
-
-        sleep(10)
-        continue
-
-    return df
+            # Get a batch of pages of vehicles in parallel.
+            batch = range(page_number, min(page_number + PAGE_BATCH_SIZE, total_pages + 1))
+            print(f"Getting pages {batch[0]}-{batch[-1]} of {MODEL} vehicles")
+
+            found_them_all = False
+            pending = list(batch)
+            for attempt in range(1, THROTTLE_ATTEMPTS + 1):
+                futures = {
+                    executor.submit(query_toyota, batch_page, headers): batch_page
+                    for batch_page in pending
+                }
+                pending = []
+                failed = 0
+                delay = 0
+                for future in as_completed(futures):
+                    result, status, retry_after = future.result()
+
+                    # Try throttled and failed pages again after a pause.
+                    if status in THROTTLE_STATUSES or not result:
+                        pending.append(futures[future])
+                        delay = max(delay, retry_delay(retry_after))
+                        failed += status not in THROTTLE_STATUSES
+                        continue
+
+                    pagination = result.get("pagination") or {}
+                    if pagination.get("totalPages") is not None:
+                        total_pages = min(pagination["totalPages"], MAX_PAGES)
+
+                    page = result["vehicleSummary"]
+                    for vehicle in page:
+                        vehicle["pageNo"] = futures[future]
+
+                    # A page without any new VINs means we're past the last vehicle.
+                    page_vins = {v["vin"] for v in page}
+                    new_vins = page_vins - seen_vins
+                    if not new_vins:
+                        found_them_all = reached_end = True
+                    elif len(new_vins - known_vins) <= len(page_vins) * new_vin_share:
+                        found_them_all = True
+
+                    seen_vins |= new_vins
+                    # Key by VIN so duplicates across pages are dropped as we go.
+                    vehicles.update((v["vin"], v) for v in page)
+
+                # Pages past the end of the results don't matter.
+                pending = sorted(p for p in pending if p <= total_pages)
+                if not pending:
+                    break
+
+                # Don't publish partial results if the server never lets us through.
+                if failed == len(batch):
+                    sys.exit(f"Failed to get any of pages {batch[0]}-{batch[-1]}, giving up.")
+
+                if attempt == THROTTLE_ATTEMPTS:
+                    sys.exit(f"Still couldn't get pages {pending}, giving up.")
+
+                print(f"Couldn't get pages {pending}, retrying in {delay} seconds.")
+                sleep(delay)
+
+            print(f"Found {len(seen_vins)} (+{len(seen_vins)-last_run_counter}) vehicles so far.\n")
+
+            if found_them_all:
+                print("All vehicles found.")
+                break
+
+            last_run_counter = len(seen_vins)
+            page_number += PAGE_BATCH_SIZE
+
+    if reached_end or batch[-1] >= total_pages:
+        return list(vehicles.values()), None
+
+    return list(vehicles.values()), batch[-1]
+
+
+def get_path(record, path):
+    """Follow a path of keys through a nested vehicle record."""
+    for key in path:
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+
+    return record
+
+
+def flatten_vehicles(vehicles):
+    """Build a DataFrame with only the columns used in the CSV."""
+    return pd.DataFrame.from_records(
+        [{name: get_path(v, path) for name, path in FLATTEN} for v in vehicles],
+        columns=_SRC_COLS,
+    )
 
 
 def update_vehicles():
@@ -143,17 +300,29 @@ def update_vehicles():
     if not DISTANCE:
         sys.exit("Set the DISTANCE environment variable first")
 
-    df = get_all_pages()
+    previous = read_previous_vehicles() if INCREMENTAL else []
+    vehicles, last_page = get_all_pages(known_vins={v["vin"] for v in previous})
 
     # Stop here if there are no vehicles to list.
-    if df.empty:
+    if not vehicles:
         print(f"No vehicles found for model: {MODEL}")
         return
 
+    # Remember when we saw each vehicle so incremental runs know when to do a
+    # full crawl again.
+    seen_at = int(time())
+    for vehicle in vehicles:
+        vehicle["lastSeen"] = seen_at
+
+    # Keep the previous run's vehicles from pages we didn't get to this time.
+    if last_page is not None:
+        carried = [v for v in previous if v.get("pageNo", 0) > last_page]
+        vehicles = list({v["vin"]: v for v in carried + vehicles}.values())
+
     # Write the raw data to a file.
-    # sync_data_to_api(df)
-    to_json_raw(df)
-    to_csv_simple(df)
+    # sync_data_to_api(pd.json_normalize(vehicles))
+    to_json_raw(vehicles)
+    to_csv_simple(flatten_vehicles(vehicles))
 
 def sync_data_to_api(df):
     json_data = df.to_json(orient="records", date_format="iso", date_unit="s")
@@ -174,103 +343,44 @@ def sync_data_to_api(df):
     else:
         print('Error sending DataFrame:', response.content)
 
-def to_json_raw(df):
-    df.to_json(f"output/{MODEL}_raw.json", orient="records", date_format="iso", date_unit="s")
+def to_json_raw(vehicles):
+    Path(f"output/{MODEL}_raw.json").write_bytes(orjson.dumps(vehicles))
 
 def to_csv_simple(df):
-    renames = {
-        "eta.currToDate": "ETA",
-        "vin": "VIN",
-        "year": "Year",
-        "model.marketingName": "Model",
-        "holdStatus": "Hold Status",
-        "isPreSold": "Pre-Sold",
-        "dealerCategory": "Shipping Status",
-        "price.totalMsrp": "Total MSRP",
-        "extColor.marketingName": "Exterior Color",
-        "intColor.marketingName": "Interior Color",
-        "distance": "Distance",
-        "dealerMarketingName": "Dealer",
-        "dealerWebsite": "Dealer Website",
-        "isSmartPath": "SmartPath",
-        "options": "Options",
-    }
-
-    df = (
-        df[
-            [
-                "eta.currToDate",
-                "vin",
-                "year",
-                "model.marketingName",
-                "holdStatus",
-                "isPreSold",
-                "dealerCategory",
-                "price.totalMsrp",
-                "extColor.marketingName",
-                "intColor.marketingName",
-                "distance",
-                "dealerMarketingName",
-                "dealerWebsite",
-                "isSmartPath",
-                "options",
-            ]
-        ]
-        .copy(deep=True)
-        .rename(columns=renames)
-    )
+    # The renamed columns are already in the order used in the CSV.
+    df = df.loc[:, _SRC_COLS].rename(columns=_RENAMES)
 
-    statuses = {None: False, 1: True, 0: False}
-    df.replace({"Pre-Sold": statuses}, inplace=True)
+    # Pre-sold is a nullable flag, so treat missing values as not pre-sold.
+    df["Pre-Sold"] = df["Pre-Sold"].fillna(False).astype(bool)
 
     statuses = {
         "A": "Factory to port",
         "F": "Port to dealer",
         "G": "At dealer",
     }
-    df.replace({"Shipping Status": statuses}, inplace=True)
+    df["Shipping Status"] = df["Shipping Status"].map(statuses).fillna(df["Shipping Status"])
 
     # when ETA is null, set as unknown, otherwise format as date
-    if df["ETA"].isnull().any():
-        df["ETA"].fillna("Unknown", inplace=True)
-    else:
-        df["ETA"] = df["ETA"].apply(lambda dt: dt.split("T")[0])
-
-    df["Options"] = df["Options"].apply(format_options)
-
-    df = df[
-        [
-            "ETA",
-            "VIN",
-            "Year",
-            "Model",
-            "Hold Status",
-            "Pre-Sold",
-            "Shipping Status",
-            "Total MSRP",
-            "Exterior Color",
-            "Interior Color",
-            "Distance",
-            "Dealer",
-            "Dealer Website",
-            "SmartPath",
-            "Options",
-        ]
-    ]
+    df["ETA"] = df["ETA"].fillna("Unknown")
+    mask = df["ETA"] != "Unknown"
+    # ETA is an ISO-8601 timestamp, so the date is the first 10 characters.
+    df.loc[mask, "ETA"] = df.loc[mask, "ETA"].str.slice(0, 10)
+
+    df["Options"] = df["Options"].map(format_options)
 
     # Write the data to a file.
-    df.sort_values(by=["VIN"], inplace=True)
-    df.to_csv(f"output/{MODEL}.csv", index=False)
+    df = df.sort_values(by=["VIN"])
+    # Render the whole CSV in memory and write it out in one go.
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    Path(f"output/{MODEL}.csv").write_text(buffer.getvalue(), encoding="utf-8", newline="")
 
 def format_options(options_raw):
     """extracts `marketingName` from `Options` col"""
-    options = set()
+    options = {}
     for item in options_raw:
-        if item.get("marketingName"):
-            options.add(item.get("marketingName"))
-        elif item.get("marketingLongName"):
-            options.add(item.get("marketingLongName"))
-        else:
-            continue
-
-    return " | ".join(sorted(options))
\ No newline at end of file
+        name = item.get("marketingName") or item.get("marketingLongName")
+        if name:
+            options[name] = None
+
+    return " | ".join(sorted(options))
@@ -1,6 +1,18 @@
 # Bypass the AWS WAF in front of the GraphQL endpoint.
+import json
+import pathlib
+import threading
+import time
+
 from playwright.sync_api import sync_playwright
 
+# Headers captured by the browser are reused until the WAF is likely to expire them.
+HEADERS_CACHE = pathlib.Path("output/headers_cache.json")
+HEADERS_TTL = 4 * 60
+
+# Only one thread at a time should launch a browser to refresh the headers.
+_REFRESH_LOCK = threading.Lock()
+
 
 class WAFBypass:
     """Bypass the AWS WAF in front of the GraphQL endpoint."""
@@ -16,7 +28,10 @@ class WAFBypass:
     def get_headers(self) -> None:
         """Run a browser to get valid headers for a WAF bypass."""
         with sync_playwright() as playwright:
-            browser = playwright.firefox.launch(headless=True)
+            browser = playwright.chromium.launch(
+                headless=True,
+                args=["--disable-blink-features=AutomationControlled"],
+            )
             context = browser.new_context(viewport={"width": 1920, "height": 1080})
             page = context.new_page()
             page.on("request", self.intercept_request)
@@ -27,7 +42,47 @@ class WAFBypass:
             page.wait_for_load_state("networkidle")
             browser.close()
 
+    @staticmethod
+    def read_cached_headers():
+        """Return the cached headers if they are still fresh."""
+        try:
+            cached = json.loads(HEADERS_CACHE.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - cached["ts"] > HEADERS_TTL:
+            return None
+
+        return cached["headers"]
+
+    @staticmethod
+    def write_cached_headers(headers) -> None:
+        """Save headers for reuse by later requests."""
+        HEADERS_CACHE.write_text(json.dumps({"ts": time.time(), "headers": headers}))
+
+    @staticmethod
+    def invalidate() -> None:
+        """Drop the cached headers so the next run launches a browser."""
+        HEADERS_CACHE.unlink(missing_ok=True)
+
     def run(self):
         """Return the valid headers to bypass the WAF."""
-        self.get_headers()
-        return self.valid_headers
+        headers = self.read_cached_headers()
+        if headers is None:
+            print("  >>> Refreshing WAF bypass >>>\n")
+            self.get_headers()
+            headers = self.valid_headers
+            self.write_cached_headers(headers)
+
+        return headers
+
+
+def refresh(rejected_headers):
+    """Replace headers that the WAF rejected, unless another thread already did."""
+    with _REFRESH_LOCK:
+        headers = WAFBypass.read_cached_headers()
+        if headers is not None and headers != rejected_headers:
+            return headers
+
+        WAFBypass.invalidate()
+        return WAFBypass().run()